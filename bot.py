@@ -1,6 +1,6 @@
 """
 RATNA-STYLE TELEGRAM EXTRACT BOT
-- Telethon + FastAPI + Uvicorn
+- Telethon + asyncio /health endpoint
 - Batch extraction with queue + progress bar
 - Private / restricted channels via user login (session)
 - Advanced settings:
@@ -12,6 +12,7 @@ RATNA-STYLE TELEGRAM EXTRACT BOT
 - Premium system:
     - OWNER_ID + /add userID -> 1000 batch
     - Others -> 3 batch
+- Settings, sessions & premium persisted in SQLite (aiosqlite, WAL)
 """
 
 import os
@@ -19,57 +20,290 @@ import asyncio
 import logging
 import time
 import re
-import uuid
+import math
+import hashlib
+import json
+import itertools
 from collections import deque
-from threading import Thread
+from types import MappingProxyType
 
-from telethon import TelegramClient, events, Button
-from telethon.tl.types import DocumentAttributeFilename
+from cachetools import LRUCache, TTLCache
+
+from telethon import TelegramClient, events, Button, utils, helpers
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.upload import GetFileRequest, SaveFilePartRequest, SaveBigFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig
 from telethon.sessions import StringSession
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError
-from fastapi import FastAPI
-import uvicorn
+from telethon.extensions import markdown
+from telethon.errors import (
+    SessionPasswordNeededError, PhoneCodeInvalidError, ChatForwardsRestrictedError,
+    FloodWaitError, MessageNotModifiedError, MessageIdInvalidError,
+)
+import aiosqlite
+import orjson
+
+# libuv event loop, must be installed before asyncio.run() creates the loop
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    try:
+        import winloop  # uvloop port for Windows
+        winloop.install()
+    except ImportError:  # neither available -> default asyncio loop
+        pass
 
 # ============= CONFIG =============
 API_ID = int(os.getenv('API_ID', '0'))
 API_HASH = os.getenv('API_HASH', '')
 BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 OWNER_ID = int(os.getenv('OWNER_ID', '0'))
+WORKERS = int(os.getenv('WORKERS', '4'))  # files processed at the same time
+TRANSFER_WORKERS = int(os.getenv('TRANSFER_WORKERS', '4'))  # parallel connections per file
+DB_PATH = os.getenv('DB_PATH', 'ratna.db')
+PORT = int(os.getenv('PORT', '8080'))  # health endpoint
+HEALTH_ENABLED = bool(int(os.getenv('HEALTH_ENABLED', '1')))  # 0 -> no /health server (e.g. worker dynos)
+USERS_CACHED = int(os.getenv('USERS_CACHED', '100000'))  # user settings kept in memory
 
 logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ============= STORAGE =============
-# users: per-user settings + state
-users = {}      # {user_id: {chat_id, state, temp, caption, rename_tag, replace_words, thumb_id}}
-sessions = {}   # {user_id: session_string}
-premium = {OWNER_ID}  # Premium users (1000 batch)
-queue = deque()       # Download queue
-active = {}           # Active downloads -> {task_id: {cur, tot, spd, uid}}
+class FairQueue:
+    """
+    Download queue, round-robin across users: workers take one task per
+    user in turn, so a 1000-file batch can't hold every worker while
+    another user's 3 files wait behind it. Items are task tuples with the
+    user_id at index 1 and the Batch last.
+    Producers can await room(uid) to wait until the user has less than
+    `per_user` tasks queued (backpressure for big batches).
+    """
 
-def get_user(uid: int):
+    def __init__(self, per_user: int):
+        self.per_user = per_user
+        self._pending = {}              # {user_id: deque(task)}
+        self._turns = asyncio.Queue()   # user_ids with pending tasks, in turn order
+        self._room = {}                 # {user_id: Event} set when room() may go on
+        self._stale = {}                # {user_id: turns left in _turns by drop()}
+        self._size = 0
+
+    def qsize(self):
+        return self._size
+
+    def put_nowait(self, item):
+        uid = item[1]
+        tasks = self._pending.get(uid)
+        if tasks is None:
+            tasks = self._pending[uid] = deque()
+            self._turns.put_nowait(uid)
+        tasks.append(item)
+        self._size += 1
+
+    async def get(self):
+        uid = await self._turns.get()
+        while self._stale.get(uid):  # turn of a dropped deque
+            self._stale[uid] -= 1
+            if not self._stale[uid]:
+                del self._stale[uid]
+            uid = await self._turns.get()
+        tasks = self._pending[uid]
+        item = tasks.popleft()
+        self._size -= 1
+        if tasks:
+            self._turns.put_nowait(uid)  # back of the line
+        else:
+            del self._pending[uid]
+        if len(tasks) < self.per_user and uid in self._room:
+            self._room.pop(uid).set()
+        return item
+
+    def drop(self, uid: int):
+        """
+        Remove all queued tasks of a user (/cancel), finishing each one as
+        cancelled in its batch. Returns how many were dropped.
+        """
+        tasks = self._pending.pop(uid, None)
+        if not tasks:
+            return 0
+        # Its turn can't be taken out of the asyncio.Queue, get() skips it
+        self._stale[uid] = self._stale.get(uid, 0) + 1
+        self._size -= len(tasks)
+        if uid in self._room:
+            self._room.pop(uid).set()
+        for task in tasks:
+            task[-1].finish(None)  # batch is the last item
+        return len(tasks)
+
+    async def room(self, uid: int):
+        while len(self._pending.get(uid, ())) >= self.per_user:
+            ev = self._room.get(uid)
+            if ev is None:
+                ev = self._room[uid] = asyncio.Event()
+            await ev.wait()
+
+# users: per-user settings + state, LRU cache in front of the SQLite users table
+users = LRUCache(maxsize=USERS_CACHED)  # {user_id: {chat_id, state, temp, caption, rename_tag, replace_words, thumb_id}}
+sessions = {}   # {user_id: session_string}
+premium = frozenset({OWNER_ID})  # Premium users (1000 batch), replaced on change, never mutated
+active = TTLCache(maxsize=10_000, ttl=3600)  # Active downloads -> {task_id: {cur, tot, spd, uid, label}}, stale entries expire
+user_tasks = {}       # {user_id: set(task_id)} queued + running tasks, used by /cancel
+running = {}          # {task_id: asyncio.Task} downloads in progress, cancelled by /cancel
+fetching = {}         # {user_id: set(asyncio.Task)} batch message fetchers, cancelled by /cancel
+task_ids = itertools.count(1)  # process-unique task ids, never persisted
+user_clients = {}     # {user_id: TelegramClient} connected user sessions, reused across tasks
+client_used = {}      # {user_id: last get_client() time.monotonic()}
+client_locks = {}     # {user_id: asyncio.Lock} one connect at a time per user
+CLIENT_IDLE = 600     # seconds before an unused user client is disconnected
+MAX_CLIENTS = 50      # connected user clients kept, least recently used idle one goes first
+EDIT_INTERVAL = 1.5   # min seconds between edits of one status message
+EDIT_INTERVAL_MAX = 30  # cap for the interval after repeated flood waits
+LOGIN_TIMEOUT = 300   # seconds an unfinished /login keeps its client connected
+FETCH_CHUNK = 100     # message ids per get_messages request (Telegram's max)
+
+# Download queue, consumed by WORKERS workers. A batch fetches its next
+# chunk only when less than FETCH_CHUNK of the user's tasks are waiting.
+queue = FairQueue(per_user=FETCH_CHUNK)
+
+# Settings of a user that never changed anything, read-only
+DEFAULT_USER = MappingProxyType({
+    'chat_id': None,
+    'state': None,
+    'temp': {},
+    'caption': None,
+    'rename_tag': None,
+    'replace_words': {},
+    'thumb_id': None,
+    '_replacer': None,
+})
+
+async def peek_user(uid: int):
     """
-    Get or init user config.
+    User config for read-only paths (cache -> unflushed changes -> SQLite).
+    Unknown users get DEFAULT_USER, nothing is cached for them, so
+    strangers opening /settings don't take a slot in `users`.
+    """
+    u = users.get(uid)
+    if u is not None:
+        return u
+    # Evicted from the cache but not flushed yet -> still the newest copy
+    u = dirty_users.get(uid)
+    if u is None:
+        async with db.execute('SELECT data FROM users WHERE user_id = ?', (uid,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return DEFAULT_USER
+        u = dict(DEFAULT_USER, temp={}, replace_words={})
+        u.update(json.loads(row[0]))
+        u['_replacer'] = compile_replace(u['replace_words'])
+    # Another handler may have loaded the same user while we awaited
+    return users.setdefault(uid, u)
+
+async def get_user(uid: int):
+    """
+    Get or init user config, for paths that change settings or state.
     New keys:
         caption: custom caption template (supports {original}, {tag})
         rename_tag: e.g. "@YourChannel"
         replace_words: dict {old: new} for caption replacement
         thumb_id: reserved for future custom thumbnail usage
+        _replacer: compiled replace_words function (see compile_replace)
+    """
+    u = await peek_user(uid)
+    if u is DEFAULT_USER:
+        u = users.setdefault(uid, dict(DEFAULT_USER, temp={}, replace_words={}))
+    return u
+
+def get_state(uid: int):
+    """
+    Conversation state without loading the user: state is never persisted,
+    so a user that isn't in memory has none.
+    """
+    u = users.get(uid) or dirty_users.get(uid)
+    return u['state'] if u else None
+
+# ============= DATABASE =============
+# Dicts above stay the hot cache, SQLite makes them survive restarts.
+db = None             # aiosqlite connection, opened in main()
+dirty_users = {}      # {user_id: user dict} settings changed since last flush
+USER_FIELDS = ('chat_id', 'caption', 'rename_tag', 'replace_words', 'thumb_id')
+FLUSH_INTERVAL = 5    # seconds between user settings flushes
+
+async def db_open():
+    global db
+    db = await aiosqlite.connect(DB_PATH)
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.executescript("""
+        CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, session TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS premium (user_id INTEGER PRIMARY KEY);
+    """)
+    await db.commit()
+
+async def db_load():
+    """
+    Fill sessions / premium from disk at startup (users load lazily in get_user).
     """
-    if uid not in users:
-        users[uid] = {
-            'chat_id': None,
-            'state': None,
-            'temp': {},
-            'caption': None,
-            'rename_tag': None,
-            'replace_words': {},
-            'thumb_id': None,
-        }
-    return users[uid]
+    global premium
+    async with db.execute('SELECT user_id, session FROM sessions') as cur:
+        async for uid, session in cur:
+            sessions[uid] = session
+    async with db.execute('SELECT user_id FROM premium') as cur:
+        premium = premium | {uid for (uid,) in await cur.fetchall()}
+
+def save_user(uid: int, u: dict):
+    """
+    Mark user settings for the next flush (batched, not one write per change).
+    Holding the dict here also keeps changes safe if the LRU evicts the user first.
+    """
+    dirty_users[uid] = u
+
+async def flush_users():
+    """
+    Write dirty users. A failed or cancelled flush puts them back for the
+    next one; changes made while it awaits re-mark the user via save_user().
+    """
+    if not dirty_users:
+        return
+    snapshot = dirty_users.copy()
+    dirty_users.clear()
+    rows = [(uid, json.dumps({k: u[k] for k in USER_FIELDS})) for uid, u in snapshot.items()]
+    try:
+        await db.executemany('INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)', rows)
+        await db.commit()
+    except BaseException:  # incl. CancelledError on shutdown
+        for uid, u in snapshot.items():
+            dirty_users.setdefault(uid, u)
+        raise
+
+async def db_flusher():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush_users()
+        except Exception as e:
+            logger.error("DB flush error: %s", e)
+
+async def save_session(uid: int):
+    if uid in sessions:
+        await db.execute('INSERT OR REPLACE INTO sessions (user_id, session) VALUES (?, ?)', (uid, sessions[uid]))
+    else:
+        await db.execute('DELETE FROM sessions WHERE user_id = ?', (uid,))
+    await db.commit()
+
+async def save_premium(uid: int):
+    if uid in premium:
+        await db.execute('INSERT OR IGNORE INTO premium (user_id) VALUES (?)', (uid,))
+    else:
+        await db.execute('DELETE FROM premium WHERE user_id = ?', (uid,))
+    await db.commit()
 
 # ============= TELEGRAM =============
-bot = TelegramClient('bot', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+# Connected + logged in by main(), handlers can register before that
+bot = TelegramClient('bot', API_ID, API_HASH)
 
 async def get_client(uid: int):
     """
@@ -77,34 +311,324 @@ async def get_client(uid: int):
     This is exactly how RATNA-style private extraction works:
     - If user session is authorized and member of private channel -> can fetch posts.
     - Else -> use bot (only for public/accessible chats).
+    Connected user clients are cached, so a batch pays one MTProto
+    handshake instead of one per file. At most MAX_CLIENTS stay connected.
     """
-    if uid in sessions:
+    if uid not in sessions:
+        return bot
+
+    async with client_locks.setdefault(uid, asyncio.Lock()):
+        c = user_clients.get(uid)
+        if c is None or not c.is_connected():
+            try:
+                c = TelegramClient(StringSession(sessions[uid]), API_ID, API_HASH)
+                await c.connect()
+                if not await c.is_user_authorized():
+                    await c.disconnect()
+                    return bot
+                user_clients[uid] = c
+                if len(user_clients) > MAX_CLIENTS:
+                    # Users with queued/running tasks keep their client
+                    idle = [x for x in user_clients if x != uid and x not in user_tasks and x not in fetching]
+                    if idle:
+                        await drop_client(min(idle, key=lambda x: client_used.get(x, 0)))
+            except Exception as e:
+                logger.error("get_client: Error using user session for %s: %s", uid, e)
+                return bot
+        client_used[uid] = time.monotonic()
+        return c
+
+async def drop_client(uid: int):
+    """
+    Disconnect + forget cached user client (logout / idle).
+    """
+    client_used.pop(uid, None)
+    lock = client_locks.get(uid)
+    if lock and not lock.locked():  # a connect in progress still needs it
+        del client_locks[uid]
+    c = user_clients.pop(uid, None)
+    if c:
+        await close_pools(c)
         try:
-            c = TelegramClient(StringSession(sessions[uid]), API_ID, API_HASH)
-            await c.connect()
-            if await c.is_user_authorized():
-                return c
-        except Exception as e:
-            logger.error(f"get_client: Error using user session for {uid}: {e}")
-    return bot
+            await c.disconnect()
+        except Exception:
+            pass
+
+async def client_janitor():
+    """
+    Disconnect user clients idle for CLIENT_IDLE seconds.
+    Users with queued/running tasks or a batch still fetching are skipped.
+    Transfer pools (also the bot's) idle that long are closed too.
+    """
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        for uid, used in list(client_used.items()):
+            if now - used > CLIENT_IDLE and uid not in user_tasks and uid not in fetching:
+                logger.info("Disconnecting idle client of %s", uid)
+                await drop_client(uid)
+        await close_pools(idle=CLIENT_IDLE)
+
+# ============= FAST TRANSFER =============
+PART_SIZE = 512 * 1024          # max MTProto part size
+BIG_FILE_SIZE = 10 * 1024 * 1024  # above this Telegram wants SaveBigFilePart
+PIPE_PARTS = 8                  # parts buffered between download and upload
+# {(0 for bot / user_id, source document id): re-uploaded Document}
+# lets a repeated file go out by reference instead of another full transfer
+reuploaded = TTLCache(maxsize=1024, ttl=1800)
+
+class DCConnectionPool:
+    """
+    MTProto senders of one client to one DC, kept between files: a protected
+    batch connects (and for a foreign DC exports authorization) once instead
+    of once per file. Closed by drop_client() or when idle (client_janitor).
+    """
 
-# ============= FASTAPI =============
-app = FastAPI()
+    def __init__(self, client: TelegramClient, dc_id: int):
+        self.client = client
+        self.dc_id = dc_id
+        # Home DC -> reuse our auth key, other DC -> export authorization once
+        self.auth_key = client.session.auth_key if dc_id == client.session.dc_id else None
+        self.senders = []
+        self.lock = asyncio.Lock()
+        self.busy = 0   # transfers using the senders right now
+        self.used = time.monotonic()
+
+    async def _create_sender(self):
+        dc = await self.client._get_dc(self.dc_id)
+        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
+        try:
+            await sender.connect(self.client._connection(
+                dc.ip_address, dc.port, dc.id,
+                loggers=self.client._log,
+                proxy=self.client._proxy,
+            ))
+            if not self.auth_key:
+                auth = await self.client(ExportAuthorizationRequest(self.dc_id))
+                self.client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+                await sender.send(InvokeWithLayerRequest(LAYER, self.client._init_request))
+                self.auth_key = sender.auth_key
+        except BaseException:  # incl. /cancel while connecting
+            await sender.disconnect()
+            raise
+        return sender
+
+    async def get(self, count: int):
+        """
+        `count` connected senders, opening the missing ones. If opening fails
+        (or we get cancelled) the new ones are closed again, they would
+        auto-reconnect forever.
+        """
+        async with self.lock:
+            self.senders = [s for s in self.senders if s.is_connected()]
+            missing = count - len(self.senders)
+            tasks = []
+            try:
+                if missing > 0 and not self.auth_key:
+                    # First sender has to export auth, the rest reuse its key
+                    tasks.append(asyncio.ensure_future(self._create_sender()))
+                    await tasks[0]
+                tasks += [asyncio.ensure_future(self._create_sender()) for _ in range(missing - len(tasks))]
+                self.senders += await asyncio.gather(*tasks)
+            except BaseException:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.gather(*[
+                    t.result().disconnect() for t in tasks
+                    if not t.cancelled() and t.exception() is None
+                ], return_exceptions=True)
+                raise
+            return self.senders[:count]
+
+    async def close(self):
+        senders, self.senders = self.senders, []
+        await asyncio.gather(*[s.disconnect() for s in senders], return_exceptions=True)
+
+dc_pools = {}  # {(client, dc_id): DCConnectionPool}
+
+async def close_pools(client: TelegramClient = None, idle: float = None):
+    """
+    Close the pools of `client` (all clients if None), with `idle` only
+    the ones no transfer used for that many seconds.
+    """
+    now = time.monotonic()
+    for key, pool in list(dc_pools.items()):
+        if client is not None and key[0] is not client:
+            continue
+        if idle is not None and (pool.busy or now - pool.used < idle):
+            continue
+        del dc_pools[key]
+        await pool.close()
+
+class ParallelTransfer:
+    """
+    FastTelethon-style file transfer.
+    Telethon moves one part at a time over a single connection, here we use
+    several MTProto connections to the DC (from its DCConnectionPool) and
+    keep one part in flight on each.
+    Used when media can't be sent by reference (protected chats).
+    """
 
-@app.get("/health")
-def health():
+    def __init__(self, client: TelegramClient, dc_id: int = None):
+        self.client = client
+        dc_id = dc_id or client.session.dc_id
+        self.pool = dc_pools.get((client, dc_id))
+        if self.pool is None:
+            self.pool = dc_pools[(client, dc_id)] = DCConnectionPool(client, dc_id)
+        self.senders = []
+
+    async def _connect(self, parts: int):
+        self.senders = await self.pool.get(max(1, min(TRANSFER_WORKERS, parts)))
+        self.pool.busy += 1
+
+    async def _close(self):
+        # Senders stay open in the pool for the next file
+        self.pool.busy -= 1
+        self.pool.used = time.monotonic()
+        self.senders = []
+
+    async def download(self, location, size: int, sink):
+        """
+        Download `location`, awaiting `sink(part)` for every part in order.
+        """
+        parts = math.ceil(size / PART_SIZE)
+        await self._connect(parts)
+        try:
+            for first in range(0, parts, len(self.senders)):
+                results = await asyncio.gather(*[
+                    self.client._call(sender, GetFileRequest(location, (first + i) * PART_SIZE, PART_SIZE))
+                    for i, sender in enumerate(self.senders) if first + i < parts
+                ])
+                for r in results:
+                    await sink(r.bytes)
+        finally:
+            await self._close()
+
+    async def upload(self, read, size: int, name: str, progress=None):
+        """
+        Upload parts returned by `await read()` and return InputFile handle for send_file.
+        """
+        file_id = helpers.generate_random_long()
+        parts = math.ceil(size / PART_SIZE)
+        big = size > BIG_FILE_SIZE
+        md5 = hashlib.md5()
+        await self._connect(parts)
+        try:
+            done = 0
+            for first in range(0, parts, len(self.senders)):
+                reqs = []
+                for i, sender in enumerate(self.senders):
+                    part = first + i
+                    if part >= parts:
+                        break
+                    data = await read()
+                    done += len(data)
+                    if big:
+                        req = SaveBigFilePartRequest(file_id, part, parts, data)
+                    else:
+                        md5.update(data)
+                        req = SaveFilePartRequest(file_id, part, data)
+                    reqs.append(self.client._call(sender, req))
+                await asyncio.gather(*reqs)
+                if progress:
+                    await progress(done, size)
+        finally:
+            await self._close()
+
+        if big:
+            return InputFileBig(file_id, parts, name)
+        return InputFile(file_id, parts, name, md5.hexdigest())
+
+async def reupload_media(client, msg, target, caption: str, fname: str, progress=None):
     """
-    Health endpoint for Render + UptimeRobot.
+    Download + upload media ourselves (protected chat, no forwarding).
+    Documents are piped part-by-part from download to upload through a small
+    bounded queue, so memory stays at a few MB and both legs overlap.
+    Photos are small -> plain Telethon.
     """
-    return {"status": "ok", "queue": len(queue), "active": len(active)}
+    if not msg.document:
+        data = await client.download_media(msg, file=bytes)
+        return await client.send_file(target, data, caption=caption)
 
-def run_api():
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv('PORT', 8080)), log_level="error")
+    size = msg.document.size
+    dc_id, location = utils.get_input_location(msg.document)
+    parts = asyncio.Queue(maxsize=PIPE_PARTS)  # full queue -> download waits for upload
 
-# Start FastAPI in background thread
-Thread(target=run_api, daemon=True).start()
+    async def pump():
+        try:
+            await ParallelTransfer(client, dc_id).download(location, size, parts.put)
+        except Exception as e:
+            await parts.put(e)
+
+    async def read():
+        part = await parts.get()
+        if isinstance(part, Exception):
+            raise part
+        return part
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        handle = await ParallelTransfer(client).upload(read, size, fname, progress)
+    finally:
+        pump_task.cancel()
+
+    # Original attributes keep name, video / streaming info, so videos
+    # stay playable instead of arriving as plain files
+    return await client.send_file(
+        target,
+        handle,
+        caption=caption,
+        attributes=msg.document.attributes,
+        mime_type=msg.document.mime_type,
+    )
+
+# ============= HEALTH SERVER =============
+HEALTH_TIMEOUT = 10   # seconds a client gets to send its request headers
+
+async def health_conn(reader, writer):
+    """
+    Health endpoint for Render + UptimeRobot: GET / HEAD /health -> queue +
+    active as JSON, anything else -> 404. One request per connection.
+    """
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEALTH_TIMEOUT)
+        parts = head.split(b" ", 2)
+        path = parts[1].split(b"?", 1)[0] if len(parts) > 1 else b""
+        if path == b"/health":
+            status = b"200 OK"
+            body = orjson.dumps({"status": "ok", "queue": queue.qsize(), "active": len(active)})
+        else:
+            status = b"404 Not Found"
+            body = b'{"detail":"Not Found"}'
+        writer.write(
+            b"HTTP/1.1 %s\r\nContent-Type: application/json\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))
+        )
+        if parts[0] != b"HEAD":  # UptimeRobot's HEAD monitors want headers only
+            writer.write(body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+async def serve_health():
+    """
+    Plain asyncio server on the bot loop: no web framework or extra
+    thread for a single JSON endpoint.
+    """
+    server = await asyncio.start_server(health_conn, "0.0.0.0", PORT)
+    async with server:
+        await server.serve_forever()
 
 # ============= HELPERS =============
+LINK_PRIVATE_RE = re.compile(r't\.me/c/(\d+)/(\d+)')
+LINK_PUBLIC_RE = re.compile(r't\.me/([^/]+)/(\d+)')
 
 def parse_link(link: str):
     """
@@ -114,27 +638,37 @@ def parse_link(link: str):
         https://t.me/<username>/<msg_id>
     Returns: (chat, msg_id) or None
     """
-    m = re.search(r't\.me/c/(\d+)/(\d+)', link)
+    if 't.me/' not in link:
+        return None
+    m = LINK_PRIVATE_RE.search(link)
     if m:
-        return (int(f"-100{m.group(1)}"), int(m.group(2)))
-    m = re.search(r't\.me/([^/]+)/(\d+)', link)
+        # Marked channel id, same as utils.get_peer_id(PeerChannel(id))
+        return (-1000000000000 - int(m.group(1)), int(m.group(2)))
+    m = LINK_PUBLIC_RE.search(link)
     if m:
         return (m.group(1), int(m.group(2)))
     return None
 
+BATCH_HEADER = "**Batch started ⚡**\n\n"
+FOOTER = "\n\n**Powered by RATNA**"
+
+# All 11 possible bars, built once instead of on every progress tick
+PROGRESS_BARS = tuple("♦" * i + "◇" * (10 - i) for i in range(11))
+
 def progress_bar(cur: int, tot: int, speed: float):
     """
     Make nice ASCII progress box like RATNA.
     """
-    pct = (cur / tot * 100) if tot > 0 else 0
-    bars = int(pct / 10)
-    bar = "♦" * bars + "◇" * (10 - bars)
+    if tot > 0:
+        pct = cur * 100 / tot
+        bar = PROGRESS_BARS[min(10, max(0, cur * 10 // tot))]  # int math, no float round trip
+    else:
+        pct = 0
+        bar = PROGRESS_BARS[0]
     mb_cur = cur / 1e6
     mb_tot = tot / 1e6
     kb_s = speed / 1024
-    eta = (tot - cur) / speed if speed > 0 else 0
-    eta_m = int(eta / 60)
-    eta_s = int(eta % 60)
+    eta_m, eta_s = divmod(int((tot - cur) / speed) if speed > 0 else 0, 60)
 
     return f"""╭─────────────────────╮
 │   Downloading...
@@ -146,21 +680,39 @@ def progress_bar(cur: int, tot: int, speed: float):
 │ ETA: {eta_m}m {eta_s}s
 ╰─────────────────────╯"""
 
-def apply_caption_logic(uid: int, original_caption: str) -> str:
+def compile_replace(mapping: dict):
+    """
+    Build one function applying every replace_words pair in a single pass.
+    Only single characters -> str.translate table, otherwise one regex
+    matching every key (longest first, so "abc" wins over "ab").
+    Compiled once per /setreplace instead of once per file.
+    """
+    if not mapping:
+        return None
+    if all(len(k) == 1 for k in mapping):
+        table = str.maketrans(mapping)
+        return lambda text: text.translate(table)
+    keys = sorted(mapping, key=len, reverse=True)
+    pattern = re.compile("|".join(map(re.escape, keys)))
+    return lambda text: pattern.sub(lambda m: mapping[m.group(0)], text)
+
+def apply_caption_logic(u: dict, original_caption: str) -> str:
     """
     Apply user settings on caption:
     1) replace_words -> text replace
     2) caption template with {original} and {tag}
     3) if no template but rename_tag set -> append tag
     """
-    u = get_user(uid)
     cap = original_caption or ""
 
-    # 1) Replace words
-    replace_map = u.get('replace_words') or {}
-    for old, new in replace_map.items():
-        if old:
-            cap = cap.replace(old, new)
+    # Nothing configured (most users) -> keep caption as is
+    if not (u['_replacer'] or u['caption'] or u['rename_tag']):
+        return cap
+
+    # 1) Replace words (single pass)
+    replacer = u.get('_replacer')
+    if replacer:
+        cap = replacer(cap)
 
     tag = u.get('rename_tag') or ""
 
@@ -181,94 +733,139 @@ def apply_caption_logic(uid: int, original_caption: str) -> str:
     return cap
 
 # ============= WORKER =============
-async def download_file(task_id: str, uid: int, chat, msg_id: int, target, status_msg):
+class StatusUpdater:
     """
-    Download & upload a single message's media.
-    Uses user session when possible, else bot.
-    Does NOT store big files on disk, just streams via Telethon.
+    Single writer for a batch status message.
+    Workers and the batch monitor only set() the latest text; one background
+    task edits the message at most once per EDIT_INTERVAL, so parallel
+    downloads can't flood Telegram (FLOOD_WAIT) with edits.
+    Text identical to what is already shown is never sent.
+    Every FLOOD_WAIT doubles the interval (up to EDIT_INTERVAL_MAX).
     """
-    client = None
-    try:
-        logger.info(f"[{task_id}] Start - Chat: {chat}, Msg: {msg_id}, Target: {target}")
 
-        # Choose client (user session or bot)
-        if uid in sessions:
+    def __init__(self, msg):
+        self.msg = msg
+        self.latest = None
+        self.sent = None  # text currently on the message
+        self.interval = EDIT_INTERVAL
+        self._dirty = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def set(self, text: str):
+        if text == self.latest:
+            return
+        self.latest = text
+        self._dirty.set()
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            text = self.latest
+            if text == self.sent:
+                continue
             try:
-                client = TelegramClient(StringSession(sessions[uid]), API_ID, API_HASH)
-                if not client.is_connected():
-                    await client.connect()
-                if not await client.is_user_authorized():
-                    logger.warning(f"[{task_id}] User session not authorized, fallback to bot")
-                    client = None
-                else:
-                    logger.info(f"[{task_id}] Using user session for private fetch")
+                await self.msg.edit(text)
+                self.sent = text
+            except MessageNotModifiedError:
+                pass
+            except FloodWaitError as e:
+                self.interval = min(self.interval * 2, EDIT_INTERVAL_MAX)
+                logger.warning("Status edit flood wait: %ss, next interval %.1fs", e.seconds, self.interval)
+                await asyncio.sleep(e.seconds)
+                self._dirty.set()  # retry with whatever is latest now
+                continue
             except Exception as e:
-                logger.error(f"[{task_id}] User client error: {e}")
-                client = None
+                logger.error("Status update error: %s", e)
+            await asyncio.sleep(self.interval)
 
-        if not client:
-            client = bot
-            logger.info(f"[{task_id}] Using bot client")
+    def close(self):
+        self._task.cancel()
 
-        # Fetch original message
-        try:
-            msg = await client.get_messages(chat, ids=msg_id)
-        except Exception as e:
-            logger.error(f"[{task_id}] Failed to get message: {e}")
-            if client != bot:
-                try:
-                    await client.disconnect()
-                except:
-                    pass
-            return False
+class Batch:
+    """
+    Counters of one /batch run, updated by workers.
+    `changed` wakes the batch monitor, `done` fires when every task is finished.
+    """
 
-        if not msg or not msg.media:
-            logger.warning(f"[{task_id}] No media found in message")
-            if client != bot:
-                try:
-                    await client.disconnect()
-                except:
-                    pass
+    def __init__(self, total: int):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.running = 0
+        self.current = None  # task_id of the latest progress tick, key into active
+        self.changed = asyncio.Event()
+        self.done = asyncio.Event()
+        if total <= 0:
+            self.done.set()
+
+    @property
+    def finished(self):
+        return self.completed + self.failed + self.cancelled
+
+    def finish(self, ok):
+        """
+        ok: True / False, None -> skipped because of /cancel
+        """
+        if ok is None:
+            self.cancelled += 1
+        elif ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        if self.finished >= self.total:
+            self.done.set()
+        self.changed.set()
+
+async def download_file(task_id: int, uid: int, msg_id: int, msg, target, status: StatusUpdater, batch: Batch):
+    """
+    Download & upload a single message's media.
+    `msg` is already fetched by the batch handler (None if it doesn't exist),
+    with user session when possible, else bot.
+    Does NOT store big files on disk, just streams via Telethon.
+    """
+    try:
+        logger.info("[%s] Start - Msg: %s, Target: %s", task_id, msg_id, target)
+
+        if not msg or not msg.file:
+            logger.warning("[%s] No media found in message", task_id)
             return False
 
-        # Determine filename
-        fname = f"file_{msg_id}"
-        if msg.document:
-            for attr in msg.document.attributes:
-                if isinstance(attr, DocumentAttributeFilename):
-                    fname = attr.file_name
+        # Same client that fetched the message (user session or bot)
+        client = msg.client
+
+        # Determine filename (Telethon already resolves name / ext / mime)
+        fname = msg.file.name or f"file_{msg_id}{msg.file.ext or ''}"
 
-        size_bytes = msg.file.size if msg.file else 0
-        logger.info(f"[{task_id}] File: {fname}, Size: {size_bytes} bytes")
+        size_bytes = msg.file.size or 0
+        logger.info("[%s] File: %s, Size: %s bytes", task_id, fname, size_bytes)
 
         # Prepare caption (with your caption/rename/replace logic)
-        original_cap = msg.text or msg.caption or ""
-        final_caption = apply_caption_logic(uid, original_cap)
+        original_cap = msg.text or ""  # media caption, Telethon has no .caption
+        final_caption = apply_caption_logic(await peek_user(uid), original_cap)
 
-        # Progress tracking
-        start = time.time()
-        last = [0]
+        # Progress tracking (loop clock: monotonic, no syscall per part)
+        label = f"\n\n**Downloading: {fname[:40]}**\n"  # status line, built once per file
+        clock = asyncio.get_running_loop().time
+        start = clock()
+        last = -3.0
 
         async def prog(cur, tot):
-            now = time.time()
-            if now - last[0] >= 3:
-                spd = cur / (now - start) if now > start else 1
-                active[task_id] = {'cur': cur, 'tot': tot, 'spd': spd, 'uid': uid}
-
-                pct = (cur / tot * 100) if tot > 0 else 0
-                logger.info(f"[{task_id}] Progress: {pct:.1f}% ({cur}/{tot} bytes) @ {spd/1024:.1f} KB/s")
-
-                if status_msg:
-                    try:
-                        txt = progress_bar(cur, tot, spd)
-                        await status_msg.edit(
-                            f"**Downloading: {fname[:40]}**\n\n{txt}\n\n**Powered by RATNA**"
-                        )
-                    except Exception as e:
-                        logger.error(f"[{task_id}] Status update error: {e}")
-                last[0] = now
-
-        logger.info(f"[{task_id}] Starting upload to target {target}")
+            nonlocal last
+            now = clock()
+            if now - last < 3:
+                return  # called once per part, almost always lands here
+            last = now
+            spd = cur / (now - start) if now > start else 1
+            active[task_id] = {'cur': cur, 'tot': tot, 'spd': spd, 'uid': uid, 'label': label}
+
+            pct = (cur / tot * 100) if tot > 0 else 0
+            logger.info("[%s] Progress: %.1f%% (%s/%s bytes) @ %.1f KB/s", task_id, pct, cur, tot, spd/1024)
+            batch.current = task_id
+            batch.changed.set()  # batch monitor renders the new progress
+
+        logger.info("[%s] Starting upload to target %s", task_id, target)
 
         # 🔥 IMPORTANT FIX:
         # Jis client se message fetch kiya (user session ya bot),
@@ -276,93 +873,104 @@ async def download_file(task_id: str, uid: int, chat, msg_id: int, target, statu
         upload_client = client  # yahi user ya bot hoga
 
         try:
-            uploaded_msg = await upload_client.send_file(
-                target,
-                msg.media,
-                caption=final_caption,
-                progress_callback=prog,
-                force_document=True,
-                file_name=fname
-            )
-            logger.info(f"[{task_id}] ✅ Upload successful, Msg ID: {uploaded_msg.id}")
-        except Exception as upload_err:
-            logger.error(f"[{task_id}] ❌ Upload failed: {upload_err}")
-            if status_msg:
+            uploaded_msg = None
+            # File handles belong to the account that uploaded them
+            cache_key = (0 if client is bot else uid, msg.document.id) if msg.document else None
+            cached = reuploaded.get(cache_key)
+            # Server-side copy by reference, no bytes move. Skipped when the
+            # message is already flagged protected since it would only fail.
+            # The media keeps its own attributes (name, streaming, photo vs
+            # document), so no force_document / file_name / progress here.
+            if cached or not msg.noforwards:
                 try:
-                    await status_msg.edit(
-                        f"❌ **Upload failed for message `{msg_id}`**\n\n"
-                        f"`{upload_err}`\n\n"
-                        "**Powered by RATNA**"
+                    uploaded_msg = await upload_client.send_file(
+                        target,
+                        cached or msg.media,
+                        caption=final_caption,
                     )
-                except Exception:
-                    pass
-
-            if upload_client != bot:
-                try:
-                    await upload_client.disconnect()
-                except:
+                except ChatForwardsRestrictedError:
                     pass
+            if uploaded_msg is None:
+                # Protected chat -> media can't be sent by reference, move the bytes
+                logger.info("[%s] Forwarding restricted, re-uploading via parallel transfer", task_id)
+                uploaded_msg = await reupload_media(upload_client, msg, target, final_caption, fname, prog)
+                if cache_key and uploaded_msg.document:
+                    reuploaded[cache_key] = uploaded_msg.document
+            logger.info("[%s] ✅ Upload successful, Msg ID: %s", task_id, uploaded_msg.id)
+        except Exception as upload_err:
+            logger.error("[%s] ❌ Upload failed: %s", task_id, upload_err)
+            if status:
+                status.set(
+                    f"❌ **Upload failed for message `{msg_id}`**\n\n`{upload_err}`" + FOOTER
+                )
             return False
 
-        if client != bot:
-            try:
-                await client.disconnect()
-            except:
-                pass
-
         return True
 
     except Exception as e:
-        logger.error(f"[{task_id}] ❌ Fatal error: {e}", exc_info=True)
-        if client and client != bot:
-            try:
-                await client.disconnect()
-            except:
-                pass
+        logger.error("[%s] ❌ Fatal error: %s", task_id, e, exc_info=True)
         return False
     finally:
-        if task_id in active:
-            del active[task_id]
-
-
-
-        
-
-    
-        
-
+        active.pop(task_id, None)
 
 async def worker():
     """
     Download queue worker – runs inside bot's event loop.
-    Processes tasks one-by-one, others stay queued.
+    WORKERS of these share the queue, so downloads overlap instead of
+    running one-by-one.
     """
-    logger.info("🔥 Worker started")
     while True:
+        tid, uid, mid, msg, target, status, batch = await queue.get()
+        ok = None
         try:
-            if queue:
-                task = queue.popleft()
-                tid, uid, chat, mid, target, status = task
-                await download_file(tid, uid, chat, mid, target, status)
-            await asyncio.sleep(1)
+            # Task dropped by /cancel while it was waiting in queue
+            if tid in user_tasks.get(uid, ()):
+                batch.running += 1
+                batch.changed.set()
+                # Own task, so /cancel can stop it without killing this worker
+                job = asyncio.create_task(download_file(tid, uid, mid, msg, target, status, batch))
+                running[tid] = job
+                try:
+                    ok = await job
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise  # worker itself is shutting down
+                    ok = None  # stopped by /cancel
+                finally:
+                    running.pop(tid, None)
+                    batch.running -= 1
         except Exception as e:
-            logger.error(f"Worker error: {e}")
-            await asyncio.sleep(2)
+            logger.error("Worker error: %s", e)
+            ok = False
+        finally:
+            tasks = user_tasks.get(uid)
+            if tasks is not None:
+                tasks.discard(tid)
+                if not tasks:
+                    del user_tasks[uid]
+            batch.finish(ok)
 
 # ============= HANDLERS =============
 
-@bot.on(events.NewMessage(pattern='/start'))
-async def cmd_start(e):
-    uid = e.sender_id
-    is_prem = uid in premium
-
-    await e.reply(
+# ---------- STATIC REPLIES ----------
+# Built once; handlers only pick the premium / free variant.
+# Texts are stored markdown-parsed as (text, entities), sent with
+# formatting_entities so Telethon doesn't re-parse them on every reply.
+MENU_BUTTONS = [
+    [Button.inline("⚙️ Settings", b"settings")],
+    [Button.inline("💎 Plan", b"plan")]
+]
+BACK_BUTTONS = [[Button.inline("🔙 Back", b"back")]]
+PLAN_STATUS = {True: '💎 Premium (1000 batch)', False: '⚪ Free (3 batch)'}
+
+START_TEXT = {
+    is_prem: markdown.parse(
         "**RATNA STYLE BOT 🔥**\n\n"
         "I can extract files from:\n"
         "✅ Private channels (after /login & if your account is member)\n"
         "✅ Public channels\n"
         "✅ Restricted channels (where your account has access)\n\n"
-        f"Status: {'💎 Premium (1000 batch)' if is_prem else '⚪ Free (3 batch)'}\n\n"
+        f"Status: {status}\n\n"
         "**Main Commands:**\n"
         "/login - Login for private channels\n"
         "/settings - Show settings help\n"
@@ -374,18 +982,32 @@ async def cmd_start(e):
         "/batch - Start extraction\n"
         "/cancel - Cancel your batch\n"
         "/myplan - Check your plan\n\n"
-        "**Powered by RATNA**",
-        buttons=[
-            [Button.inline("⚙️ Settings", b"settings")],
-            [Button.inline("💎 Plan", b"plan")]
-        ]
+        "**Powered by RATNA**"
     )
+    for is_prem, status in PLAN_STATUS.items()
+}
+MENU_TEXT = {
+    is_prem: markdown.parse(f"**RATNA STYLE BOT 🔥**\n\nStatus: {status}\n\nChoose option:")
+    for is_prem, status in PLAN_STATUS.items()
+}
+PLAN_TEXT = {
+    True: markdown.parse("💎 **Premium Active**\n\nBatch limit: 1000 files\nSpeed: Fast\nAll features unlocked."),
+    False: markdown.parse("⚪ **Free Plan**\n\nBatch limit: 3 files\nSpeed: Standard."),
+}
+MYPLAN_TEXT = {
+    True: markdown.parse("💎 **Premium Active**\n\nBatch: 1000 files\nSpeed: Fast\nAll features unlocked."),
+    False: markdown.parse("⚪ **Free Plan**\n\nBatch: 3 files\nSpeed: Standard."),
+}
+
+async def cmd_start(e):
+    text, entities = START_TEXT[e.sender_id in premium]
+    await e.reply(text, formatting_entities=entities, buttons=MENU_BUTTONS)
 
 @bot.on(events.CallbackQuery(pattern=b"settings"))
 async def cb_settings(e):
     await e.answer()
     uid = e.sender_id
-    u = get_user(uid)
+    u = await peek_user(uid)
 
     # Build short preview
     cap_preview = u['caption'] or "Default (original caption)"
@@ -405,43 +1027,26 @@ async def cb_settings(e):
         "`/setrename` - set rename tag\n"
         "`/setreplace` - set word replacements\n"
         "`/resetsettings` - reset everything",
-        buttons=[[Button.inline("🔙 Back", b"back")]]
+        buttons=BACK_BUTTONS
     )
 
 @bot.on(events.CallbackQuery(pattern=b"plan"))
 async def cb_plan(e):
     await e.answer()
-    uid = e.sender_id
-    is_prem = uid in premium
-
-    if is_prem:
-        txt = "💎 **Premium Active**\n\nBatch limit: 1000 files\nSpeed: Fast\nAll features unlocked."
-    else:
-        txt = "⚪ **Free Plan**\n\nBatch limit: 3 files\nSpeed: Standard."
-    await e.edit(txt, buttons=[[Button.inline("🔙 Back", b"back")]])
+    text, entities = PLAN_TEXT[e.sender_id in premium]
+    await e.edit(text, formatting_entities=entities, buttons=BACK_BUTTONS)
 
 @bot.on(events.CallbackQuery(pattern=b"back"))
 async def cb_back(e):
     await e.answer()
-    uid = e.sender_id
-    is_prem = uid in premium
-
-    await e.edit(
-        f"**RATNA STYLE BOT 🔥**\n\n"
-        f"Status: {'💎 Premium (1000 batch)' if is_prem else '⚪ Free (3 batch)'}\n\n"
-        "Choose option:",
-        buttons=[
-            [Button.inline("⚙️ Settings", b"settings")],
-            [Button.inline("💎 Plan", b"plan")]
-        ]
-    )
+    text, entities = MENU_TEXT[e.sender_id in premium]
+    await e.edit(text, formatting_entities=entities, buttons=MENU_BUTTONS)
 
 # ---------- SETTINGS COMMANDS ----------
 
-@bot.on(events.NewMessage(pattern='/settings'))
 async def cmd_settings(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await peek_user(uid)
     cap_preview = u['caption'] or "Default (original caption)"
     tag_preview = u['rename_tag'] or "Not set"
     rep_map = u['replace_words'] or {}
@@ -461,10 +1066,9 @@ async def cmd_settings(e):
         "`/resetsettings` - Reset all settings"
     )
 
-@bot.on(events.NewMessage(pattern='/setchatid'))
 async def cmd_setchatid(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
     u['state'] = 'wait_chatid'
     await e.reply(
         "📌 **Set Chat ID**\n\n"
@@ -472,10 +1076,9 @@ async def cmd_setchatid(e):
         "Example: `-1001234567890`"
     )
 
-@bot.on(events.NewMessage(pattern='/setcaption'))
 async def cmd_setcaption(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
     u['state'] = 'wait_caption'
     await e.reply(
         "📝 **Set Caption Template**\n\n"
@@ -486,10 +1089,9 @@ async def cmd_setcaption(e):
         "`{original}\\n\\nUploaded by {tag}`"
     )
 
-@bot.on(events.NewMessage(pattern='/setrename'))
 async def cmd_setrename(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
     u['state'] = 'wait_rename'
     await e.reply(
         "🏷 **Set Rename Tag**\n\n"
@@ -497,10 +1099,9 @@ async def cmd_setrename(e):
         "`@YourChannel` or `Uploaded by @YourChannel`"
     )
 
-@bot.on(events.NewMessage(pattern='/setreplace'))
 async def cmd_setreplace(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
     u['state'] = 'wait_replace'
     await e.reply(
         "🔤 **Set Replace Words**\n\n"
@@ -510,22 +1111,22 @@ async def cmd_setreplace(e):
         "`t.me/oldchannel => t.me/newchannel || OldName => NewName`"
     )
 
-@bot.on(events.NewMessage(pattern='/resetsettings'))
 async def cmd_resetsettings(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
     u['caption'] = None
     u['rename_tag'] = None
     u['replace_words'] = {}
+    u['_replacer'] = None
     u['thumb_id'] = None
     u['state'] = None
+    save_user(uid, u)
     await e.reply("♻️ **All settings reset to default!**")
 
 # ---------- LOGIN / BATCH / PLAN / ADMIN ----------
 
-@bot.on(events.NewMessage(pattern='/login'))
 async def cmd_login(e):
-    u = get_user(e.sender_id)
+    u = await get_user(e.sender_id)
     u['state'] = 'wait_phone'
     await e.reply(
         "🔐 **Login**\n\n"
@@ -533,19 +1134,19 @@ async def cmd_login(e):
         "Example: `+919876543210`"
     )
 
-@bot.on(events.NewMessage(pattern='/logout'))
 async def cmd_logout(e):
     uid = e.sender_id
     if uid in sessions:
         del sessions[uid]
+        await save_session(uid)
+        await drop_client(uid)
         await e.reply("✅ Logged out!")
     else:
         await e.reply("⚠️ Not logged in.")
 
-@bot.on(events.NewMessage(pattern='/batch'))
 async def cmd_batch(e):
     uid = e.sender_id
-    u = get_user(uid)
+    u = await get_user(uid)
 
     if not u['chat_id']:
         await e.reply("⚠️ First set target chat ID: `/setchatid` or `/settings`")
@@ -554,296 +1155,470 @@ async def cmd_batch(e):
     u['state'] = 'wait_link'
     await e.reply("🔗 **Send post link:**\n\nExample: `https://t.me/channel/123`")
 
-@bot.on(events.NewMessage(pattern='/cancel'))
 async def cmd_cancel(e):
     uid = e.sender_id
-    removed = 0
-
-    # Remove tasks of this user from queue
-    new_q = deque()
-    for task in queue:
-        if task[1] != uid:
-            new_q.append(task)
-        else:
-            removed += 1
-
-    queue.clear()
-    queue.extend(new_q)
 
-    await e.reply(f"✅ Cancelled! Removed {removed} queued tasks.")
+    # Queued tasks leave the queue now (their batches finish right away),
+    # running ones are cancelled (frees connection + worker)
+    tasks = user_tasks.pop(uid, set())
+    for fetcher in fetching.pop(uid, ()):
+        fetcher.cancel()  # not yet fetched messages are dropped too
+    removed = queue.drop(uid)
+    stopped = 0
+    for tid in tasks:
+        job = running.get(tid)
+        if job:
+            job.cancel()
+            stopped += 1
+
+    await e.reply(f"✅ Cancelled! Removed {removed} queued tasks, stopped {stopped} running.")
 
-@bot.on(events.NewMessage(pattern='/myplan'))
 async def cmd_myplan(e):
-    uid = e.sender_id
-    is_prem = uid in premium
+    text, entities = MYPLAN_TEXT[e.sender_id in premium]
+    await e.reply(text, formatting_entities=entities)
 
-    if is_prem:
-        await e.reply("💎 **Premium Active**\n\nBatch: 1000 files\nSpeed: Fast\nAll features unlocked.")
-    else:
-        await e.reply("⚪ **Free Plan**\n\nBatch: 3 files\nSpeed: Standard.")
-
-@bot.on(events.NewMessage(pattern=r'^/add (\d+)$'))
 async def cmd_add(e):
+    global premium
     if e.sender_id != OWNER_ID:
         return
     uid = int(e.pattern_match.group(1))
-    premium.add(uid)
+    premium = premium | {uid}
+    await save_premium(uid)
     await e.reply(f"✅ Added `{uid}` to premium (1000 batch).")
 
-@bot.on(events.NewMessage(pattern=r'^/rem (\d+)$'))
 async def cmd_rem(e):
+    global premium
     if e.sender_id != OWNER_ID:
         return
     uid = int(e.pattern_match.group(1))
     if uid in premium and uid != OWNER_ID:
-        premium.discard(uid)
+        premium = premium - {uid}
+        await save_premium(uid)
         await e.reply(f"✅ Removed `{uid}` from premium.")
 
-@bot.on(events.NewMessage(pattern='/stats'))
 async def cmd_stats(e):
     if e.sender_id != OWNER_ID:
         return
+    await flush_users()
+    async with db.execute('SELECT COUNT(*) FROM users') as cur:
+        (n_users,) = await cur.fetchone()
 
     await e.reply(
         "📊 **Stats**\n\n"
-        f"Users: {len(users)}\n"
+        f"Users: {n_users}\n"
         f"Premium: {len(premium)}\n"
-        f"Queue: {len(queue)}\n"
+        f"Queue: {queue.qsize()}\n"
         f"Active: {len(active)}\n"
-        f"Sessions: {len(sessions)}"
+        f"Sessions: {len(sessions)}\n"
+        f"Loop: {type(asyncio.get_running_loop()).__module__}"
     )
 
-# ============= MESSAGE HANDLER (STATE MACHINE) =============
-
-@bot.on(events.NewMessage)
-async def msg_handler(e):
-    uid = e.sender_id
-    txt = e.text.strip() if e.text else ""
-    u = get_user(uid)
-    state = u.get('state')
-
-    if not state:
+# ---------- COMMAND DISPATCH ----------
+# One handler + dict lookup instead of one regex handler per command.
+COMMANDS = {
+    '/start': cmd_start,
+    '/settings': cmd_settings,
+    '/setchatid': cmd_setchatid,
+    '/setcaption': cmd_setcaption,
+    '/setrename': cmd_setrename,
+    '/setreplace': cmd_setreplace,
+    '/resetsettings': cmd_resetsettings,
+    '/login': cmd_login,
+    '/logout': cmd_logout,
+    '/batch': cmd_batch,
+    '/cancel': cmd_cancel,
+    '/myplan': cmd_myplan,
+    '/stats': cmd_stats,
+}
+
+# Commands with arguments -> handler gets e.pattern_match
+ARG_COMMANDS = (
+    (re.compile(r'^/add (\d+)$'), cmd_add),
+    (re.compile(r'^/rem (\d+)$'), cmd_rem),
+)
+
+@bot.on(events.NewMessage(pattern=r'^/'))
+async def cmd_dispatch(e):
+    text = e.raw_text
+    # "/start@MyBot arg" -> "/start"
+    cmd = text.split(maxsplit=1)[0].split('@', 1)[0]
+    handler = COMMANDS.get(cmd)
+    if handler:
+        await handler(e)
         return
-
-    # ---------- LOGIN FLOW ----------
-    if state == 'wait_phone':
-        if not txt.startswith('+'):
-            await e.reply("❌ Send with country code: `+919876543210`")
+    for pattern, handler in ARG_COMMANDS:
+        m = pattern.match(text)
+        if m:
+            e.pattern_match = m
+            await handler(e)
             return
-        try:
-            c = TelegramClient(StringSession(), API_ID, API_HASH)
-            await c.connect()
-            result = await c.send_code_request(txt)
-
-            u['temp'] = {'phone': txt, 'hash': result.phone_code_hash, 'client': c}
-            u['state'] = 'wait_otp'
-            await e.reply("📱 **OTP sent!**\n\nStep 2: Send OTP like: `1 2 3 4 5`")
-        except Exception as ex:
-            await e.reply(f"❌ Error: {ex}")
-            u['state'] = None
 
-    elif state == 'wait_otp':
-        try:
-            otp = txt.replace(' ', '')
-            tmp = u['temp']
-            c = tmp['client']
-
-            try:
-                await c.sign_in(phone=tmp['phone'], code=otp, phone_code_hash=tmp['hash'])
-            except SessionPasswordNeededError:
-                u['state'] = 'wait_2fa'
-                await e.reply("🔐 **2FA Required**\n\nStep 3: Send 2FA password")
-                return
+# ============= MESSAGE HANDLER (STATE MACHINE) =============
 
-            sessions[uid] = c.session.save()
-            await c.disconnect()
+# ---------- LOGIN FLOW ----------
 
-            u['state'] = None
-            u['temp'] = {}
-            await e.reply("✅ **Login successful!**")
-        except PhoneCodeInvalidError:
-            await e.reply("❌ Invalid OTP! Try `/login` again.")
-            u['state'] = None
-        except Exception as ex:
-            await e.reply(f"❌ Error: {ex}")
-            u['state'] = None
+async def expire_login(u, c):
+    """
+    Drop an abandoned login: each /login needs its own client (sign_in binds
+    it to that account), so make sure it doesn't stay connected forever.
+    """
+    await asyncio.sleep(LOGIN_TIMEOUT)
+    if u['temp'].get('client') is c:
+        await end_login(u)
 
-    elif state == 'wait_2fa':
+async def end_login(u):
+    """
+    Close the pending /login (done, failed or timed out): stop its timer,
+    disconnect its client. The state is reset only while it still waits for
+    this login, a prompt the user moved on to (/setchatid, /batch, a new
+    /login) is kept.
+    """
+    tmp = u['temp']
+    u['temp'] = {}
+    if u['state'] in ('wait_otp', 'wait_2fa'):
+        u['state'] = None
+    timer = tmp.get('expire')
+    if timer and timer is not asyncio.current_task():
+        timer.cancel()
+    c = tmp.get('client')
+    if c:
         try:
-            tmp = u['temp']
-            c = tmp['client']
-            await c.sign_in(password=txt)
-
-            sessions[uid] = c.session.save()
             await c.disconnect()
+        except Exception:
+            pass
 
-            u['state'] = None
-            u['temp'] = {}
-            await e.reply("✅ **Login successful with 2FA!**")
-        except Exception as ex:
-            await e.reply(f"❌ Invalid password: {ex}")
-            u['state'] = None
+async def state_wait_phone(e, uid, u, txt):
+    if not txt.startswith('+'):
+        await e.reply("❌ Send with country code: `+919876543210`")
+        return
+    await end_login(u)  # previous attempt still waiting for its OTP
+    try:
+        c = TelegramClient(StringSession(), API_ID, API_HASH)
+        await c.connect()
+        result = await c.send_code_request(txt)
+
+        u['temp'] = {'phone': txt, 'hash': result.phone_code_hash, 'client': c}
+        u['state'] = 'wait_otp'
+        u['temp']['expire'] = asyncio.create_task(expire_login(u, c))
+        await e.reply("📱 **OTP sent!**\n\nStep 2: Send OTP like: `1 2 3 4 5`")
+    except Exception as ex:
+        await e.reply(f"❌ Error: {ex}")
+        u['state'] = None
+
+async def state_wait_otp(e, uid, u, txt):
+    try:
+        otp = txt.replace(' ', '')
+        tmp = u['temp']
+        c = tmp['client']
 
-    # ---------- SETTINGS FLOW ----------
-    elif state == 'wait_chatid':
         try:
-            cid = int(txt)
-            u['chat_id'] = cid
-            u['state'] = None
-            await e.reply(
-                f"✅ **Chat ID set!**\n\n"
-                f"Target: `{cid}`\n\n"
-                "Now use `/batch` to start extraction."
-            )
-        except Exception:
-            await e.reply("❌ Invalid! Send number like: `-1001234567890`")
+            await c.sign_in(phone=tmp['phone'], code=otp, phone_code_hash=tmp['hash'])
+        except SessionPasswordNeededError:
+            u['state'] = 'wait_2fa'
+            await e.reply("🔐 **2FA Required**\n\nStep 3: Send 2FA password")
+            return
 
-    elif state == 'wait_caption':
-        # Save caption template
-        u['caption'] = txt
+        await drop_client(uid)  # old cached session, if any
+        sessions[uid] = c.session.save()
+        await save_session(uid)
+        await end_login(u)
+        await e.reply("✅ **Login successful!**")
+    except PhoneCodeInvalidError:
+        await end_login(u)
+        await e.reply("❌ Invalid OTP! Try `/login` again.")
+    except Exception as ex:
+        await end_login(u)
+        await e.reply(f"❌ Error: {ex}")
+
+async def state_wait_2fa(e, uid, u, txt):
+    try:
+        tmp = u['temp']
+        c = tmp['client']
+        await c.sign_in(password=txt)
+
+        await drop_client(uid)  # old cached session, if any
+        sessions[uid] = c.session.save()
+        await save_session(uid)
+        await end_login(u)
+        await e.reply("✅ **Login successful with 2FA!**")
+    except Exception as ex:
+        await end_login(u)
+        await e.reply(f"❌ Invalid password: {ex}")
+
+# ---------- SETTINGS FLOW ----------
+
+async def state_wait_chatid(e, uid, u, txt):
+    try:
+        cid = int(txt)
+        u['chat_id'] = cid
         u['state'] = None
+        save_user(uid, u)
         await e.reply(
-            "✅ **Caption template saved!**\n\n"
-            "Remember you can use `{original}` and `{tag}` placeholders."
+            f"✅ **Chat ID set!**\n\n"
+            f"Target: `{cid}`\n\n"
+            "Now use `/batch` to start extraction."
         )
+    except Exception:
+        await e.reply("❌ Invalid! Send number like: `-1001234567890`")
 
-    elif state == 'wait_rename':
-        u['rename_tag'] = txt
-        u['state'] = None
-        await e.reply(f"✅ **Rename tag set to:** `{txt}`")
-
-    elif state == 'wait_replace':
-        # Parse "old => new || old2 => new2"
-        mapping = {}
-        parts = [p.strip() for p in txt.split("||") if p.strip()]
-        for part in parts:
-            if "=>" in part:
-                old, new = part.split("=>", 1)
-                old = old.strip()
-                new = new.strip()
-                if old:
-                    mapping[old] = new
-
-        u['replace_words'] = mapping
-        u['state'] = None
+async def state_wait_caption(e, uid, u, txt):
+    # Save caption template
+    u['caption'] = txt
+    u['state'] = None
+    save_user(uid, u)
+    await e.reply(
+        "✅ **Caption template saved!**\n\n"
+        "Remember you can use `{original}` and `{tag}` placeholders."
+    )
 
-        preview = ", ".join([f"'{k}'→'{v}'" for k, v in mapping.items()]) or "None"
-        await e.reply(f"✅ **Replace words updated:** {preview}")
+async def state_wait_rename(e, uid, u, txt):
+    u['rename_tag'] = txt
+    u['state'] = None
+    save_user(uid, u)
+    await e.reply(f"✅ **Rename tag set to:** `{txt}`")
+
+async def state_wait_replace(e, uid, u, txt):
+    # Parse "old => new || old2 => new2"
+    mapping = {}
+    parts = [p.strip() for p in txt.split("||") if p.strip()]
+    for part in parts:
+        if "=>" in part:
+            old, new = part.split("=>", 1)
+            old = old.strip()
+            new = new.strip()
+            if old:
+                mapping[old] = new
+
+    u['replace_words'] = mapping
+    u['_replacer'] = compile_replace(mapping)
+    u['state'] = None
+    save_user(uid, u)
 
-    # ---------- BATCH FLOW ----------
-    elif state == 'wait_link':
-        parsed = parse_link(txt)
-        if not parsed:
-            await e.reply("❌ Invalid link!\nSend Telegram post link like: `https://t.me/c/...` or `https://t.me/channel/123`")
-            return
+    preview = ", ".join([f"'{k}'→'{v}'" for k, v in mapping.items()]) or "None"
+    await e.reply(f"✅ **Replace words updated:** {preview}")
 
-        u['batch_chat'], u['batch_start'] = parsed
-        u['state'] = 'wait_count'
+# ---------- BATCH FLOW ----------
 
-        max_lim = 1000 if uid in premium else 3
-        await e.reply(f"**How many files?**\n\nMax: `{max_lim}`")
+async def state_wait_link(e, uid, u, txt):
+    parsed = parse_link(txt)
+    if not parsed:
+        await e.reply("❌ Invalid link!\nSend Telegram post link like: `https://t.me/c/...` or `https://t.me/channel/123`")
+        return
 
-    elif state == 'wait_count':
-        try:
-            count = int(txt)
-            max_lim = 1000 if uid in premium else 3
+    u['batch_chat'], u['batch_start'] = parsed
+    u['state'] = 'wait_count'
 
-            if count > max_lim:
-                await e.reply(f"❌ Max `{max_lim}`! Check your plan: `/myplan`")
-                return
+    max_lim = 1000 if uid in premium else 3
+    await e.reply(f"**How many files?**\n\nMax: `{max_lim}`")
 
-            u['state'] = None
-            target = u['chat_id']
-            chat = u['batch_chat']
-            start_id = u['batch_start']
+async def state_wait_count(e, uid, u, txt):
+    try:
+        count = int(txt)
+        max_lim = 1000 if uid in premium else 3
 
-            status = await e.reply(
-                f"**Batch started ⚡**\n\n"
-                f"Processing: 0/{count}\n\n"
-                f"**Powered by RATNA**"
-            )
+        if count > max_lim:
+            await e.reply(f"❌ Max `{max_lim}`! Check your plan: `/myplan`")
+            return
 
-            # Add tasks to queue
-            for i in range(count):
-                tid = str(uuid.uuid4())
-                mid = start_id + i
-                queue.append((tid, uid, chat, mid, target, status))
+        u['state'] = None
+        target = u['chat_id']
+        chat = u['batch_chat']
+        start_id = u['batch_start']
 
-            logger.info(f"Added {count} tasks for user {uid}")
+        status_msg = await e.reply(BATCH_HEADER + f"Processing: 0/{count}" + FOOTER)
 
-            # Monitor progress
-            completed = 0
-            last_completed = -1
+        # Messages are fetched FETCH_CHUNK ids per request instead of one
+        # get_messages RPC per file. Only the first chunk is awaited here
+        # (errors reported right away), the rest is fetched while workers
+        # already download. Target resolved to an input peer once.
+        ids = range(start_id, start_id + count)
+        try:
+            client = await get_client(uid)
+            msgs = await client.get_messages(chat, ids=list(ids[:FETCH_CHUNK]))
+        except Exception as ex:
+            logger.error("Batch fetch failed for user %s: %s", uid, ex)
+            await status_msg.edit(f"❌ **Can't fetch messages:** `{ex}`" + FOOTER)
+            return
+        try:
+            target_peer = await client.get_input_entity(target)
+        except Exception as ex:
+            logger.error("Target %s not resolvable for user %s: %s", target, uid, ex)
+            await status_msg.edit(
+                f"❌ **Can't access target chat** `{target}`: `{ex}`\n\n"
+                "Check it with `/setchatid`" + FOOTER
+            )
+            return
 
-            while completed < count:
-                await asyncio.sleep(5)
+        # Add tasks to queue
+        batch = Batch(count)
+        status = StatusUpdater(status_msg)
 
-                in_queue = sum(1 for t in queue if t[1] == uid)
-                in_active = sum(1 for t_id, data in active.items() if data.get('uid') == uid)
+        def enqueue(mids, msgs):
+            tasks = user_tasks.setdefault(uid, set())
+            for mid, msg in zip(mids, msgs):
+                tid = next(task_ids)
+                tasks.add(tid)
+                queue.put_nowait((tid, uid, mid, msg, target_peer, status, batch))
 
-                completed = count - in_queue - in_active
+        async def fetch_rest():
+            for first in range(FETCH_CHUNK, count, FETCH_CHUNK):
+                mids = ids[first:first + FETCH_CHUNK]
+                try:
+                    await queue.room(uid)
+                    enqueue(mids, await client.get_messages(chat, ids=list(mids)))
+                except asyncio.CancelledError:  # /cancel
+                    ok = None
+                except Exception as ex:
+                    logger.error("Batch fetch failed for user %s at %s: %s", uid, mids[0], ex)
+                    ok = False
+                else:
+                    continue
+                # Never fetched -> still count them so the batch finishes
+                for _ in range(count - first):
+                    batch.finish(ok)
+                return
 
-                # Progress of current active download
-                progress_text = ""
-                for t_id, data in active.items():
-                    if data.get('uid') == uid:
-                        cur = data.get('cur', 0)
-                        tot = data.get('tot', 1)
-                        spd = data.get('spd', 0)
-                        progress_text = f"\n\n{progress_bar(cur, tot, spd)}"
-                        break
+        enqueue(ids[:FETCH_CHUNK], msgs)
+        if count > FETCH_CHUNK:
+            fetcher = asyncio.create_task(fetch_rest())
+            fetchers = fetching.setdefault(uid, set())
+            fetchers.add(fetcher)
+
+            def fetch_done(t):
+                fetchers.discard(t)
+                if not fetchers and fetching.get(uid) is fetchers:
+                    del fetching[uid]
+
+            fetcher.add_done_callback(fetch_done)
+
+        logger.info("Added %s tasks for user %s", count, uid)
+
+        # Monitor progress -> wakes up only when a worker reports something
+        # (task started / finished, or a progress tick of a download)
+        last_key = None
+        while not batch.done.is_set():
+            await batch.changed.wait()
+            batch.changed.clear()
+
+            completed = batch.finished
+            in_active = batch.running
+            data = active.get(batch.current)
+
+            # Nothing visible moved -> don't even build the text
+            key = (completed, in_active, data and data.get('cur'))
+            if key == last_key:
+                continue
+            last_key = key
+            in_queue = count - completed - in_active
+
+            # Progress of current active download
+            progress_text = ""
+            if data:
+                cur = data.get('cur', 0)
+                tot = data.get('tot', 1)
+                spd = data.get('spd', 0)
+                progress_text = data['label'] + progress_bar(cur, tot, spd)
+
+            if not batch.done.is_set():
+                status.set(
+                    BATCH_HEADER
+                    + f"Completed: {completed}/{count}\nQueue: {in_queue}\nActive: {in_active}{progress_text}"
+                    + FOOTER
+                )
 
-                if completed != last_completed or progress_text:
-                    try:
-                        msg_text = (
-                            f"**Batch started ⚡**\n\n"
-                            f"Completed: {completed}/{count}\n"
-                            f"Queue: {in_queue}\n"
-                            f"Active: {in_active}"
-                            f"{progress_text}\n\n"
-                            f"**Powered by RATNA**"
-                        )
-                        await status.edit(msg_text)
-                        last_completed = completed
-                    except Exception as ex:
-                        logger.error(f"Status update failed: {ex}")
-
-                # Safety: if nothing left in queue/active but completed < count, break
-                if in_queue == 0 and in_active == 0:
-                    break
-
-            # Final summary
+        # Final summary
+        status.close()
+        summary = (
+            "✅ **Batch completed!**\n\n"
+            f"Total requested: {count}\n"
+            f"Successful: {batch.completed}\n"
+            f"Failed: {batch.failed}\n"
+            f"Cancelled: {batch.cancelled}\n\n"
+            f"Check your channel: `{target}`" + FOOTER
+        )
+        # Don't lose the summary to a flood wait, retry once after it
+        for _ in range(2):
             try:
-                await status.edit(
-                    "✅ **Batch completed!**\n\n"
-                    f"Total requested: {count}\n"
-                    f"Approx successful: {completed}\n"
-                    f"Approx failed: {count - completed}\n\n"
-                    f"Check your channel: `{target}`\n\n"
-                    "**Powered by RATNA**"
-                )
-            except Exception:
-                pass
+                await status_msg.edit(summary)
+                break
+            except FloodWaitError as ex:
+                await asyncio.sleep(ex.seconds + 0.5)
+            except (MessageNotModifiedError, MessageIdInvalidError):
+                break  # already shown / status message deleted
+            except Exception as ex:
+                logger.warning("Batch summary edit failed: %s", ex)
+                break
+
+    except ValueError:
+        await e.reply("❌ Invalid number! Send a valid integer.")
+
+# ---------- STATE DISPATCH ----------
+# state -> handler(e, uid, u, txt), one dict lookup per message
+STATES = {
+    'wait_phone': state_wait_phone,
+    'wait_otp': state_wait_otp,
+    'wait_2fa': state_wait_2fa,
+    'wait_chatid': state_wait_chatid,
+    'wait_caption': state_wait_caption,
+    'wait_rename': state_wait_rename,
+    'wait_replace': state_wait_replace,
+    'wait_link': state_wait_link,
+    'wait_count': state_wait_count,
+}
 
-        except ValueError:
-            await e.reply("❌ Invalid number! Send a valid integer.")
+@bot.on(events.NewMessage)
+async def msg_handler(e):
+    if (e.raw_text or '').startswith('/'):
+        return  # commands are handled by cmd_dispatch
+    uid = e.sender_id
+    # Most messages aren't replies to a prompt -> no user load, no DB read
+    state = get_state(uid)
+    if not state:
+        return
+    txt = e.text.strip() if e.text else ""
+    u = await get_user(uid)
+    await STATES[state](e, uid, u, txt)
 
 # ============= MAIN =============
 
-def main():
-    logger.info("=" * 50)
-    logger.info("🚀 RATNA STYLE BOT STARTED")
-    logger.info("=" * 50)
-    logger.info(f"Owner: {OWNER_ID}")
-    logger.info(f"Premium users: {len(premium)}")
-    logger.info("✅ All systems ready")
-    logger.info("=" * 50)
-
-    # Start worker
-    bot.loop.create_task(worker())
+async def main():
+    # Restore saved state first: Telethon dispatches updates as soon as
+    # the bot connects, handlers need the DB and the premium set by then
+    await db_open()
+    await db_load()
+    await bot.start(bot_token=BOT_TOKEN)
+
+    logger.info("\n".join([
+        "=" * 50,
+        "🚀 RATNA STYLE BOT STARTED",
+        "=" * 50,
+        f"Owner: {OWNER_ID}",
+        f"Premium users: {len(premium)}",
+        f"Health: port {PORT}" if HEALTH_ENABLED else "Health: disabled",
+        "✅ All systems ready",
+        "=" * 50,
+    ]))
+
+    # Start health server + workers
+    background = [
+        asyncio.create_task(client_janitor()),
+        asyncio.create_task(db_flusher()),
+    ]
+    if HEALTH_ENABLED:
+        background.append(asyncio.create_task(serve_health()))
+    background += [asyncio.create_task(worker()) for _ in range(WORKERS)]
+    logger.info("🔥 %s workers started", WORKERS)
 
     # Run bot
-    bot.run_until_disconnected()
+    try:
+        await bot.run_until_disconnected()
+    finally:
+        for t in background:
+            t.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await close_pools()
+        await flush_users()
+        await db.close()
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())